@@ -14,6 +14,7 @@ Options:
   --right-only     Build only right side
   --device=NAME    Device to build for (from devices.conf)
   --no-debug       Disable USB debugging
+  --pristine       Force a clean (pristine) build instead of an incremental one
   --help           Show this help message
 """
 
@@ -23,85 +24,168 @@ import argparse
 import subprocess
 import shutil
 import json
+import pickle
+import logging
+import re
+import hashlib
+import functools
+import threading
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 
+class BatchedStreamHandler(logging.StreamHandler):
+    """StreamHandler that flushes every 50ms from a background thread, and at once for warnings and errors"""
+    flush_interval = 0.05
+    
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        # The timer keeps lines from sitting in the buffer through quiet phases such as linking
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+    
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    
+    def emit(self, record):
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.WARNING:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
 # Setup logging with timestamps
+log_handler = BatchedStreamHandler(sys.stdout)
+logging.basicConfig(level=logging.INFO, handlers=[log_handler],
+                    format="[%(asctime)s] [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %H:%M:%S")
+logger = logging.getLogger("cornezmk")
+
 def log(message, level="INFO"):
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] [{level}] {message}")
-    sys.stdout.flush()  # Ensure output is shown immediately
+    logger.log(logging.getLevelName(level), message)
 
-# Add the lib directory to the Python path so we can import the setup module
+# Python already puts this script's directory on sys.path, so lib imports as a package
 script_dir = Path(__file__).resolve().parent
-lib_dir = script_dir / "lib"
-sys.path.insert(0, str(lib_dir))
-
-import setup
+from lib import setup
+from lib.fileutil import reflink_or_copy, file_sha256
 setup.initialize_venv(["pyyaml", "west", "pyelftools"])
 import yaml
 
+# Use the libyaml-backed loader and dumper when PyYAML was built with it
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
+# Build output lines that are logged at ERROR level
+ERROR_LINE_PATTERN = re.compile(r"(error|Error|ERROR|FAIL|FAILED):")
+
+# Path to the Python executable in the virtual environment
+if sys.platform == 'win32':
+    PYTHON_EXECUTABLE = os.path.join(setup.VENV_DIR, "Scripts", "python.exe")
+else:
+    PYTHON_EXECUTABLE = os.path.join(setup.VENV_DIR, "bin", "python")
+
 # Check for required tools before proceeding
 def check_required_tools():
-    """Check if all required tools are installed"""
+    """Check if all required tools are installed (looked up on PATH, nothing is run)"""
     required_tools = {
         # West is now installed in the virtual environment
         "cmake": {
-            "command": ["cmake", "--version"],
             "package": "pacman -S extra/cmake",
             "description": "Build system generator"
         },
         "git": {
-            "command": ["git", "--version"],
             "package": "pacman -S extra/git",
             "description": "Version control system"
         }
     }
     
+    # Tools that speed up the build but aren't needed for it to work
+    optional_tools = {
+        "ccache": {
+            "package": "pacman -S extra/ccache",
+            "description": "Compiler cache"
+        }
+    }
+    
     missing_tools = []
+    found_optional_tools = []
     
     for tool, info in required_tools.items():
-        try:
-            subprocess.run(info["command"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        if shutil.which(tool) is not None:
             log(f"Found {tool}: {info['description']}")
-        except (subprocess.SubprocessError, FileNotFoundError):
+        else:
             missing_tools.append((tool, info["package"], info["description"]))
     
+    for tool, info in optional_tools.items():
+        if shutil.which(tool) is not None:
+            log(f"Found {tool}: {info['description']}")
+            found_optional_tools.append(tool)
+        else:
+            log(f"Optional tool {tool} not found ({info['description']}); install with: {info['package']}", level="WARNING")
+    
     if missing_tools:
         log("Missing required tools:", level="ERROR")
         for tool, package, description in missing_tools:
             log(f"  - {tool}: {description}", level="ERROR")
             log(f"    Install with: {package}", level="ERROR")
         sys.exit(1)
-
-# Check for required tools
-check_required_tools()
+    
+    return found_optional_tools
 
 
 def find_root_dir(start_dir=None):
-    """Find CorneZMK root directory by looking up two levels from the script location"""
-    # Use the script directory as the starting point
+    """Find CorneZMK root directory by walking up from the script location"""
+    # Use the script directory as the starting point; the root is the first directory
+    # above it that has the devices config and west manifest
     script_dir = Path(__file__).resolve().parent
+    for candidate in [script_dir, *script_dir.parents]:
+        if (candidate / "etc" / "devices.conf").is_file() and (candidate / "config" / "west.yml").is_file():
+            return candidate
+    return None
+
+
+def read_devices_yaml(config_path):
+    """Parse devices.conf, reusing a pickled copy of the last parse if the file is unchanged"""
+    st = os.stat(config_path)
+    cache_key = (os.path.abspath(config_path), st.st_mtime_ns, st.st_size)
+    cache_file = os.path.join(get_cache_dir(root_dir), "devices-conf.pkl")
     
-    # The root directory is two levels up from the script directory (scripts/build-local.py)
-    root_dir = script_dir.parent
+    try:
+        with open(cache_file, 'rb') as file:
+            cached = pickle.load(file)
+        if cached["key"] == cache_key:
+            return cached["config"]
+    except Exception:
+        pass
     
-    # Verify this is actually the CorneZMK directory
-    if (root_dir / "config").is_dir() and (root_dir / "etc").is_dir():
-        return root_dir
-    else:
-        return None
+    with open(config_path, 'r') as file:
+        config = yaml.load(file, Loader=SafeLoader)
+    
+    try:
+        with open(cache_file, 'wb') as file:
+            pickle.dump({"key": cache_key, "config": config}, file)
+    except OSError as e:
+        log(f"Could not cache devices configuration: {e}", level="WARNING")
+    
+    return config
 
 
 def load_devices_config(config_path):
-    """Load device configuration from YAML file"""
+    """Load device configuration from YAML file, returning (document, devices)"""
     try:
-        with open(config_path, 'r') as file:
-            config = yaml.safe_load(file)
-            # Check if the config has a 'devices' root key
-            if 'devices' in config:
-                return config['devices']
-            return config
+        config = read_devices_yaml(config_path)
+        # Check if the config has a 'devices' root key
+        if 'devices' in config:
+            return config, config['devices']
+        return config, config
     except Exception as e:
         log(f"Error loading devices configuration: {e}", level="ERROR")
         sys.exit(1)
@@ -137,16 +221,16 @@ def check_prerequisites(config_path, keyboard_name, zmk_path, exit_on_error=True
     if not board_found:
         # Get all directories in zmk_path that might be modules
         try:
-            for item in os.listdir(zmk_path):
-                module_path = os.path.join(zmk_path, item)
-                if os.path.isdir(module_path):
-                    # Check if this module has a boards/arm directory
-                    board_dir = os.path.join(module_path, "boards", "arm", keyboard_name)
-                    checked_locations.append(board_dir)
-                    if os.path.isdir(board_dir):
-                        board_found = True
-                        log(f"Found board definition in module: {board_dir}")
-                        break
+            with os.scandir(zmk_path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        # Check if this module has a boards/arm directory
+                        board_dir = os.path.join(entry.path, "boards", "arm", keyboard_name)
+                        checked_locations.append(board_dir)
+                        if os.path.isdir(board_dir):
+                            board_found = True
+                            log(f"Found board definition in module: {board_dir}")
+                            break
         except Exception as e:
             log(f"Error scanning modules: {e}", level="ERROR")
     
@@ -172,97 +256,164 @@ def setup_zmk(zmk_path, root_dir):
     # Clone ZMK if not present
     if not os.path.isdir(os.path.join(zmk_path, "app")):
         log("ZMK not found. Cloning ZMK repository...")
-        # Clone directly into the zmk_path instead of creating a nested directory
-        subprocess.run(["git", "clone", "https://github.com/zmkfirmware/zmk.git", "."], cwd=zmk_path, check=True)
-
-    # Get path to Python executable in the virtual environment
-    if sys.platform == 'win32':
-        python_executable = os.path.join(setup.VENV_DIR, "Scripts", "python.exe")
-    else:
-        python_executable = os.path.join(setup.VENV_DIR, "bin", "python")
+        # Clone directly into the zmk_path instead of creating a nested directory.
+        # Only the working tree is needed for building, so skip history and tags.
+        # Protocol v2 trims the ref advertisement; --jobs parallelizes any submodule fetches.
+        log_handler.flush()  # Keep our lines ahead of the child's output on the shared stdout
+        subprocess.run(["git", "-c", "protocol.version=2", "-c", "fetch.parallel=0",
+                        "clone", "--depth=1", "--filter=blob:none", "--no-tags",
+                        "--jobs", str(os.cpu_count() or 4),
+                        "https://github.com/zmkfirmware/zmk.git", "."], cwd=zmk_path, check=True)
 
     # Initialize ZMK workspace if needed
     if not os.path.isfile(os.path.join(zmk_path, ".west", "config")):
         log("Initializing ZMK workspace...")
         
-        # Change to ZMK directory and initialize west using the venv Python
-        os.chdir(zmk_path)
-        subprocess.run([python_executable, "-m", "west", "init", "-l", "app"], check=True)
+        # Initialize west in the ZMK directory using the venv Python
+        log_handler.flush()
+        subprocess.run([PYTHON_EXECUTABLE, "-m", "west", "init", "-l", "app"], cwd=zmk_path, check=True)
+
+    # Copy west.yml file, leaving the existing copy (and its mtime) alone when it's identical
+    source_west_yml = os.path.join(root_dir, "config", "west.yml")
+    west_yml = os.path.join(zmk_path, "app", "west.yml")
+    manifest_hash = file_sha256(source_west_yml)
+    if not os.path.isfile(west_yml) or file_sha256(west_yml) != manifest_hash:
+        reflink_or_copy(source_west_yml, west_yml)
 
-    # Copy west.yml file
-    shutil.copy(os.path.join(root_dir, "config", "west.yml"), os.path.join(zmk_path, "app", "west.yml"))
+    # Skip the update if the manifest hasn't changed since the last successful one
+    hash_file = os.path.join(get_var_dir(root_dir), "west-manifest.hash")
+    
+    if manifest_hash == read_manifest_hash(hash_file) and modules_populated(zmk_path):
+        log("west.yml unchanged; skipping west update")
+        return
 
     # Update ZMK dependencies
     log("Updating ZMK dependencies...")
     
-    # Change to ZMK directory and update west using the venv Python
-    os.chdir(zmk_path)
-    subprocess.run([python_executable, "-m", "west", "update"], check=True)
+    # Fetch modules shallow and narrow (no extra tags/branches) as well
+    update_cmd = [PYTHON_EXECUTABLE, "-m", "west", "update", "--narrow", "--fetch-opt=--depth=1"]
+    
+    # Clone modules from a local mirror cache so repeat updates don't hit the network
+    if west_supports_auto_cache():
+        cache_dir = os.path.join(get_cache_dir(root_dir), "west-mirror")
+        os.makedirs(cache_dir, exist_ok=True)
+        update_cmd += ["--auto-cache", cache_dir, "--fetch=smart"]
+    else:
+        log("Installed west does not support --auto-cache; updating without a mirror cache", level="WARNING")
+    
+    # Update west in the ZMK directory using the venv Python
+    log_handler.flush()
+    subprocess.run(update_cmd, cwd=zmk_path, check=True)
+    
+    # Remember the manifest we just updated to
+    with open(hash_file, 'w') as file:
+        file.write(manifest_hash)
 
 
-def build_firmware(side, build_command, zmk_path, root_dir, timing_callback=None, build_opts=None):
-    """Build firmware for a specific side"""
-    log(f"Starting build for {side} side")
+def west_supports_auto_cache():
+    """Check if the installed west has `west update --auto-cache` (added in west 1.1)"""
+    try:
+        from west.version import __version__ as west_version
+        major, minor = (int(part) for part in west_version.split(".")[:2])
+        return (major, minor) >= (1, 1)
+    except Exception:
+        return False
+
+
+def read_manifest_hash(hash_file):
+    """Read the west.yml hash recorded by the last successful west update"""
+    try:
+        with open(hash_file, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def modules_populated(zmk_path):
+    """Check if west update has already checked out the ZMK modules"""
+    modules_dir = os.path.join(zmk_path, "modules")
+    return os.path.isdir(modules_dir) and len(os.listdir(modules_dir)) > 0
+
+
+def needs_pristine_on_change(filename):
+    """Check if a board file feeds the cmake/Kconfig configuration (keymaps don't)"""
+    return (filename == "board.cmake" or filename.startswith("Kconfig")
+            or filename.endswith(("_defconfig", ".dts", ".dtsi", ".yaml")))
+
+
+def compute_build_key(zmk_path, root_dir, keyboard_name, shield_param, build_opts, launcher_opts=()):
+    """Hash the inputs that require a pristine build when they change"""
+    key = hashlib.sha256()
     
-    # Change to ZMK directory
-    os.chdir(zmk_path)
+    # The manifest decides which module revisions are compiled in
+    west_yml = os.path.join(zmk_path, "app", "west.yml")
+    if os.path.isfile(west_yml):
+        with open(west_yml, 'rb') as file:
+            key.update(file.read())
     
-    # Get path to Python executable in the virtual environment
-    if sys.platform == 'win32':
-        python_executable = os.path.join(setup.VENV_DIR, "Scripts", "python.exe")
-    else:
-        python_executable = os.path.join(setup.VENV_DIR, "bin", "python")
+    key.update(shield_param.encode())
+    key.update(" ".join(build_opts).encode())
+    key.update(" ".join(launcher_opts).encode())
     
-    # Prepare build command using the virtual environment's Python
-    # Instead of running 'west build' directly, run it as 'python -m west build'
-    if build_command.startswith("west "):
-        # Replace 'west ' with 'python -m west '
-        build_command = f"{python_executable} -m {build_command}"
+    # Board definition files (keymap edits alone don't need a pristine build)
+    board_dir = os.path.join(root_dir, "boards", "arm", keyboard_name)
+    for dirpath, _, filenames in os.walk(board_dir):
+        for filename in sorted(filenames):
+            if not needs_pristine_on_change(filename):
+                continue
+            path = os.path.join(dirpath, filename)
+            key.update(f"{path}:{os.stat(path).st_mtime_ns}".encode())
     
-    cmd = build_command.split()
+    return key.hexdigest()
+
+
+def read_build_key(build_key_file):
+    """Read the build key recorded by the last successful build"""
+    try:
+        with open(build_key_file, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def build_firmware(side, cmd, zmk_path, root_dir, timing_callback=None, build_opts=None, env=None):
+    """Build firmware for a specific side, running the argv list cmd"""
+    log(f"Starting build for {side} side")
     
-    # Use Popen with pipes for both stdout and stderr
+    # Prepare build command using the virtual environment's Python
+    # Instead of running 'west build' directly, run it as 'python -m west build'.
+    # This stays a subprocess rather than calling west.app.main in-process: west finds
+    # its workspace from the process cwd and cmake/ninja write straight to fd 1, which
+    # would break both the concurrent side builds and the per-side output capture.
+    if cmd[0] == "west":
+        # Replace 'west' with 'python -m west'
+        cmd = [PYTHON_EXECUTABLE, "-m", *cmd]
+    
+    # Use Popen with stderr merged into a single stdout pipe. Run from the ZMK directory
+    # via cwd= rather than os.chdir, since both sides may be building at once.
     process = subprocess.Popen(
         cmd,
+        cwd=zmk_path,
         stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        universal_newlines=True,
-        bufsize=1,
-        errors='replace'  # Handle any encoding issues gracefully
+        stderr=subprocess.STDOUT,
+        env=env
     )
     
-    # Read from both stdout and stderr in real-time
-    def read_stream(stream, print_func):
-        for line in iter(stream.readline, ''):
-            if line:
-                print_func(line.rstrip())
-        stream.close()
-    
-    # Start threads to read both streams
-    import threading
-    stdout_thread = threading.Thread(
-        target=read_stream,
-        args=(process.stdout, lambda x: log(f"[stdout] {x}"))
-    )
-    stderr_thread = threading.Thread(
-        target=read_stream,
-        args=(process.stderr, lambda x: log(f"[stderr] {x}", level="ERROR"))
-    )
-    
-    stdout_thread.daemon = True
-    stderr_thread.daemon = True
-    stdout_thread.start()
-    stderr_thread.start()
+    # Read the output in real-time, flagging error lines by their content
+    for line in process.stdout:
+        line = line.decode(errors='replace').rstrip()
+        if ERROR_LINE_PATTERN.search(line):
+            logger.error("[%s] %s", side, line)
+        else:
+            logger.info("[%s] %s", side, line)
+    process.stdout.close()
+    log_handler.flush()
     
     # Wait for process to complete
     returncode = process.wait()
     
-    # Wait for threads to finish
-    stdout_thread.join(timeout=1)
-    stderr_thread.join(timeout=1)
-    
     if returncode != 0:
-        log(f"Error: Build command failed (exit code {returncode})", level="ERROR")
+        log(f"Error: {side} side build command failed (exit code {returncode})", level="ERROR")
         return False, returncode
     
     return True, returncode
@@ -278,9 +429,17 @@ def copy_firmware(side, build_output, result_firmware, results_dir, root_dir):
         log(f"Error: Firmware file not found at {build_output}", level="ERROR")
         return False
     
+    # Skip the copy if the results directory already has identical firmware, so its
+    # mtime only changes when the firmware does
+    if (os.path.isfile(result_firmware)
+            and os.path.getsize(result_firmware) == os.path.getsize(build_output)
+            and file_sha256(result_firmware) == file_sha256(build_output)):
+        log(f"Firmware at {result_firmware} is unchanged")
+        return True
+    
     # Copy firmware file
     try:
-        shutil.copy(build_output, result_firmware)
+        reflink_or_copy(build_output, result_firmware)
         log(f"Firmware copied to {result_firmware}")
         return True
     except Exception as e:
@@ -288,38 +447,109 @@ def copy_firmware(side, build_output, result_firmware, results_dir, root_dir):
         return False
 
 
-def generate_build_info(script_dir):
-    """Generate build info by calling generate_build_info.sh"""
-    # Change to script directory to ensure relative paths work
-    original_dir = os.getcwd()
-    os.chdir(script_dir)
+def get_head_key(git_dir):
+    """Get the inputs that determine what HEAD resolves to, or None if they can't be read"""
+    try:
+        with open(os.path.join(git_dir, "HEAD"), 'r') as file:
+            head = file.read().strip()
+    except OSError:
+        return None
+    
+    def mtime_ns(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return 0
     
+    # A branch ref may be a loose file or live in packed-refs
+    ref_mtime = 0
+    if head.startswith("ref: "):
+        ref_mtime = mtime_ns(os.path.join(git_dir, head[len("ref: "):]))
+    return [head, ref_mtime, mtime_ns(os.path.join(git_dir, "packed-refs"))]
+
+
+def get_commit_hash(script_dir):
+    """Get the short commit hash of HEAD, only asking git when HEAD may have moved"""
+    git_dir = os.path.join(root_dir, ".git")
+    head_key = get_head_key(git_dir) if os.path.isdir(git_dir) else None
+    cache_file = os.path.join(get_cache_dir(root_dir), "head-sha.json")
+    
+    if head_key is not None:
+        try:
+            with open(cache_file, 'r') as file:
+                cached = json.load(file)
+            if cached["key"] == head_key:
+                return cached["sha"]
+        except Exception:
+            pass
+    
+    commit_hash = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], 
+                                        cwd=script_dir, universal_newlines=True).strip()
+    
+    if head_key is not None:
+        try:
+            with open(cache_file, 'w') as file:
+                json.dump({"key": head_key, "sha": commit_hash}, file)
+        except OSError:
+            pass
+    
+    return commit_hash
+
+
+# ZMK keycodes for the characters generate_build_info.sh knows about (anything else becomes SPACE)
+BUILD_INFO_KEYCODES = {
+    **{c: f"N{c}" for c in "0123456789"},
+    **{c: c.upper() for c in "abcdefghijklmnopqrstuvwxyz"},
+    **{c: c for c in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"},
+    "-": "MINUS", "_": "UNDER", ":": "COLON", " ": "SPACE",
+    ".": "DOT", "/": "SLASH", "<": "LT", ">": "GT",
+}
+
+BUILD_INFO_TEMPLATE = """/ {{
+   macros {{
+       build_time: build_time {{
+           compatible = "zmk,behavior-macro";
+           #binding-cells = <0>;
+           bindings = <&macro_tap{keycodes}>;
+       }};
+   }};
+}};
+"""
+
+def generate_build_info(script_dir):
+    """Generate config/build_info.dtsi (same output as generate_build_info.sh, without the shell)"""
     try:
         # Get current git commit hash
         try:
-            commit_hash = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], 
-                                                universal_newlines=True).strip()
-            commit_arg = ["--commit", commit_hash]
-        except:
-            commit_arg = []
+            commit_hash = get_commit_hash(script_dir)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log(f"Could not determine git commit: {e}", level="WARNING")
+            commit_hash = None
         
-        # Run generate_build_info.sh
-        subprocess.run(["./generate_build_info.sh"] + commit_arg, check=True)
-        log("Generated build info")
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        if commit_hash:
+            message = f"Built from commit {commit_hash} {timestamp}"
+        else:
+            message = f"ZMK built {timestamp}"
+        
+        # Convert to keycode sequence
+        keycodes = "".join(f" &kp {BUILD_INFO_KEYCODES.get(char, 'SPACE')}" for char in message)
+        
+        output_file = os.path.join(script_dir, "..", "config", "build_info.dtsi")
+        with open(output_file, 'w') as file:
+            file.write(BUILD_INFO_TEMPLATE.format(keycodes=keycodes))
+        log(f"Generated build_info.dtsi with timestamp: {timestamp}")
     except Exception as e:
         log(f"Error generating build info: {e}", level="ERROR")
-    finally:
-        # Change back to original directory
-        os.chdir(original_dir)
 
 
-def update_devices_conf(devices_conf_path, device_name, keyboard_name):
-    """Update devices.conf with proper firmware names if needed"""
+def update_devices_conf(devices_conf_path, devices_conf, device_name, keyboard_name):
+    """Update devices.conf with proper firmware names if needed
+    
+    devices_conf is the already-parsed devices.conf document; it is updated in place
+    and only written back to devices_conf_path if something changed.
+    """
     try:
-        # Load devices.conf
-        with open(devices_conf_path, 'r') as file:
-            devices_conf = yaml.safe_load(file)
-        
         # Check if device exists
         if device_name not in devices_conf:
             log(f"Warning: Device {device_name} not found in devices.conf", level="WARNING")
@@ -340,82 +570,99 @@ def update_devices_conf(devices_conf_path, device_name, keyboard_name):
         # Save updated devices.conf if modified
         if modified:
             with open(devices_conf_path, 'w') as file:
-                yaml.dump(devices_conf, file, default_flow_style=False)
+                yaml.dump(devices_conf, file, Dumper=SafeDumper, default_flow_style=False)
             log(f"Updated devices.conf with firmware names for {device_name}")
     except Exception as e:
         log(f"Error updating devices.conf: {e}", level="ERROR")
 
 
+@functools.lru_cache(maxsize=None)
 def get_repo_name(root_dir):
-    """Get repository name from git or directory name"""
+    """Get repository name from git or directory name (computed once per root_dir)"""
     try:
         # Try to get the repository name from git
-        original_dir = os.getcwd()
-        os.chdir(root_dir)
-        try:
-            # Check if this is a git repository
-            result = subprocess.run(["git", "rev-parse", "--is-inside-work-tree"], 
-                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+        # Check if this is a git repository
+        result = subprocess.run(["git", "rev-parse", "--is-inside-work-tree"], 
+                              cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
+                              universal_newlines=True, check=False)
+        if result.returncode == 0:
+            # Get the repository name from the remote URL or directory name
+            result = subprocess.run(["git", "config", "--get", "remote.origin.url"], 
+                                  cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
                                   universal_newlines=True, check=False)
-            if result.returncode == 0:
-                # Get the repository name from the remote URL or directory name
-                result = subprocess.run(["git", "config", "--get", "remote.origin.url"], 
-                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE, 
-                                      universal_newlines=True, check=False)
-                if result.returncode == 0 and result.stdout.strip():
-                    # Extract repo name from URL (handles various formats)
-                    url = result.stdout.strip()
-                    # Remove .git suffix if present
-                    if url.endswith(".git"):
-                        url = url[:-4]
-                    # Get the last part of the URL (the repo name)
-                    repo_name = os.path.basename(url)
-                    return repo_name
-        finally:
-            os.chdir(original_dir)
+            if result.returncode == 0 and result.stdout.strip():
+                # Extract repo name from URL (handles various formats)
+                url = result.stdout.strip()
+                # Remove .git suffix if present
+                if url.endswith(".git"):
+                    url = url[:-4]
+                # Get the last part of the URL (the repo name)
+                repo_name = os.path.basename(url)
+                return repo_name
     except Exception as e:
         log(f"Error getting git repository name: {e}", level="WARNING")
     
     # Fallback to directory name
     return os.path.basename(os.path.abspath(root_dir))
 
+def get_cache_dir(root_dir):
+    """Get (and create) the ~/.cache/<repo-name> directory for disposable caches"""
+    cache_dir = os.path.join(str(Path.home()), ".cache", get_repo_name(root_dir))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def get_var_dir(root_dir):
+    """Get (and create) the ~/.local/var/<repo-name> directory for local build state"""
+    var_dir = os.path.join(str(Path.home()), ".local", "var", get_repo_name(root_dir))
+    os.makedirs(var_dir, exist_ok=True)
+    return var_dir
+
+# Both sides may finish building concurrently, so serialize access to the stats file
+build_stats_lock = threading.Lock()
+
+def migrate_build_stats(legacy_file, stats_file):
+    """Convert a legacy build-stats.json list into build-stats.jsonl lines"""
+    try:
+        with open(legacy_file, 'r') as file:
+            stats = json.load(file)
+        with open(stats_file, 'a') as file:
+            for entry in stats:
+                file.write(json.dumps(entry) + "\n")
+        os.replace(legacy_file, legacy_file + ".bak")
+        log(f"Migrated {legacy_file} to {stats_file}")
+    except Exception as e:
+        log(f"Error migrating legacy build stats: {e}", level="WARNING")
+
+
 def save_build_stat(side, build_opts, start_time, end_time, duration, returncode):
-    """Save build statistics to a JSON file in ~/.local/var/<repo-name>/build-stats.json"""
+    """Append build statistics to ~/.local/var/<repo-name>/build-stats.jsonl"""
     try:
-        # Get repository name
-        repo_name = get_repo_name(root_dir)
-        
-        # Create stats directory in user's local directory
-        stats_dir = os.path.join(str(Path.home()), ".local", "var", repo_name)
-        os.makedirs(stats_dir, exist_ok=True)
-        
-        # Create stats file
-        stats_file = os.path.join(stats_dir, "build-stats.json")
-        
-        # Load existing stats if file exists
-        stats = []
-        if os.path.isfile(stats_file):
-            try:
-                with open(stats_file, 'r') as file:
-                    stats = json.load(file)
-            except:
-                stats = []
-        
-        # Add new stats
-        stats.append({
-            "timestamp": datetime.now().isoformat(),
-            "side": side,
-            "build_opts": build_opts,
-            "start_time": start_time.isoformat(),
-            "end_time": end_time.isoformat(),
-            "duration_seconds": duration,
-            "returncode": returncode,
-            "success": returncode == 0
-        })
-        
-        # Save stats
-        with open(stats_file, 'w') as file:
-            json.dump(stats, file, indent=2)
+        with build_stats_lock:
+            # Stats file in user's local directory, one JSON record per line
+            var_dir = get_var_dir(root_dir)
+            stats_file = os.path.join(var_dir, "build-stats.jsonl")
+            
+            # One-off migration from the old whole-file JSON format
+            legacy_file = os.path.join(var_dir, "build-stats.json")
+            if os.path.isfile(legacy_file):
+                migrate_build_stats(legacy_file, stats_file)
+            
+            entry = {
+                "timestamp": datetime.now().isoformat(),
+                "side": side,
+                "build_opts": build_opts,
+                "start_time": start_time.isoformat(),
+                "end_time": end_time.isoformat(),
+                "duration_seconds": duration,
+                "returncode": returncode,
+                "success": returncode == 0
+            }
+            
+            # Append the new stats, locking against other builds running at the same time
+            with open(stats_file, 'a') as file:
+                if fcntl is not None:
+                    fcntl.flock(file, fcntl.LOCK_EX)
+                file.write(json.dumps(entry) + "\n")
             
         log(f"Build statistics saved to {stats_file}")
     except Exception as e:
@@ -430,6 +677,7 @@ def main():
     parser.add_argument("--right-only", dest="right_only", action="store_true", help="Build only right side")
     parser.add_argument("--device", dest="device", help="Device to build for (from devices.conf)")
     parser.add_argument("--no-debug", dest="no_debug", action="store_true", help="Disable USB debugging")
+    parser.add_argument("--pristine", dest="pristine", action="store_true", help="Force a clean (pristine) build")
     
     args = parser.parse_args()
     
@@ -442,9 +690,14 @@ def main():
     
     log(f"CorneZMK root directory: {root_dir}")
     
-    # Load device configuration
+    # Check for required tools and load device configuration. These are independent,
+    # so overlap the tool probes with the YAML parse.
     devices_conf_path = os.path.join(root_dir, "etc", "devices.conf")
-    devices_conf = load_devices_config(devices_conf_path)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        tools_future = executor.submit(check_required_tools)
+        devices_future = executor.submit(load_devices_config, devices_conf_path)
+        optional_tools_found = tools_future.result()
+        devices_doc, devices_conf = devices_future.result()
     
     # Determine device to build for
     device_name = args.device or next(iter(devices_conf.keys()))
@@ -502,7 +755,7 @@ def main():
     generate_build_info(script_dir)
     
     # Update devices.conf with firmware names
-    update_devices_conf(devices_conf_path, device_name, keyboard_name)
+    update_devices_conf(devices_conf_path, devices_doc, device_name, keyboard_name)
     
     # Build firmware
     success = True
@@ -512,6 +765,27 @@ def main():
     if args.no_debug:
         build_opts.append("-DCONFIG_ZMK_USB_LOGGING=n")
     
+    # Compile through ccache when available so unchanged sources are cache hits
+    cmake_launcher_opts = []
+    if "ccache" in optional_tools_found:
+        log_handler.flush()
+        subprocess.run(["ccache", "--max-size=5G"], stdout=subprocess.DEVNULL, check=False)
+        cmake_launcher_opts = ["-DCMAKE_C_COMPILER_LAUNCHER=ccache", "-DCMAKE_CXX_COMPILER_LAUNCHER=ccache"]
+    
+    # Determine which sides were requested
+    sides = []
+    if build_left:
+        sides.append("left")
+    if build_right:
+        sides.append("right")
+    
+    # Make sure the compile runs on every core, whatever cmake decides on its own,
+    # splitting the cores between the sides that build concurrently
+    build_jobs = str(max(1, (os.cpu_count() or 4) // len(sides)))
+    build_env = os.environ.copy()
+    build_env["CMAKE_BUILD_PARALLEL_LEVEL"] = build_jobs
+    build_env["MAKEFLAGS"] = f"-j{build_jobs}"
+    
     # Function to build a specific side
     def build_side(side, build_opts, zmk_path, root_dir, results_dir, keyboard_name, shield_name):
         """Build firmware for a specific side"""
@@ -521,31 +795,53 @@ def main():
         # For split keyboards, append _left or _right to the shield name
         shield_param = f"{shield_name}_{side}" if side in ["left", "right"] else shield_name
         
-        build_command = f"west build -p -b nice_nano_v2 -d build/{side} app -- -DSHIELD={shield_param} {' '.join(build_opts)}"
+        # Only force a pristine build when the inputs that affect the build configuration
+        # changed; otherwise reuse the previous build directory (and the ccache)
+        build_key_file = os.path.join(zmk_path, "build", side, ".build-key")
+        build_key = compute_build_key(zmk_path, root_dir, keyboard_name, shield_param, build_opts,
+                                      cmake_launcher_opts)
+        if args.pristine:
+            log(f"Pristine build requested for {side} side")
+            pristine = "always"
+        elif build_key == read_build_key(build_key_file):
+            pristine = "auto"
+        else:
+            log(f"Build configuration for {side} side changed; doing a pristine build")
+            pristine = "always"
+        
+        build_cmd = [
+            "west", "build", "-p", pristine, "-b", "nice_nano_v2", "-d", f"build/{side}",
+            f"--build-opt=-j{build_jobs}", "app",
+            "--", f"-DSHIELD={shield_param}", *build_opts, *cmake_launcher_opts
+        ]
         
         start_time = datetime.now()
-        side_success, side_returncode = build_firmware(side, build_command, zmk_path, root_dir, build_opts=build_opts)
+        side_success, side_returncode = build_firmware(side, build_cmd, zmk_path, root_dir, build_opts=build_opts, env=build_env)
         end_time = datetime.now()
         duration = (end_time - start_time).total_seconds()
         
         save_build_stat(side, build_opts, start_time, end_time, duration, side_returncode)
         
         if side_success:
+            with open(build_key_file, 'w') as file:
+                file.write(build_key)
+            
             build_output = os.path.join(zmk_path, "build", side, "zephyr", "zmk.uf2")
             result_firmware = os.path.join(results_dir, f"{keyboard_name}_{side}-nice_nano_v2-zmk.uf2")
             copy_firmware(side, build_output, result_firmware, results_dir, root_dir)
             return True
         return False
     
-    # Build left side if requested
-    if build_left:
-        if not build_side("left", build_opts, zmk_path, root_dir, results_dir, keyboard_name, shield_name):
-            success = False
+    # The sides use separate build directories and are independent, so build them concurrently
+    with ThreadPoolExecutor(max_workers=len(sides)) as executor:
+        futures = [
+            executor.submit(build_side, side, build_opts, zmk_path, root_dir, results_dir, keyboard_name, shield_name)
+            for side in sides
+        ]
+        results = [future.result() for future in futures]
     
-    # Build right side if requested
-    if build_right:
-        if not build_side("right", build_opts, zmk_path, root_dir, results_dir, keyboard_name, shield_name):
-            success = False
+    if not all(results):
+        success = False
     
     # Print summary
     if success:
@@ -6,242 +6,283 @@ import yaml
 import subprocess
 import re
 import argparse
+import functools
+import stat
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+# One property per line, either bare (udevadm --query=property) or as an E: record
+# (udev database, udevadm --query=all); other record types such as S: never match
+# Matched on the raw bytes; only the captured key and value get decoded
+_UDEV_PROPERTY = re.compile(rb'^(?:E: ?)?([A-Z0-9_]+)=(.*)$', re.MULTILINE)
+
 def get_script_dir():
     """Get the directory where this script is located, resolving symlinks."""
     script_path = os.path.realpath(__file__)
     return os.path.dirname(script_path)
 
+def _find_devices_conf():
+    """Walk up from the script directory to the checkout holding etc/devices.conf."""
+    script_dir = Path(get_script_dir())
+    for path in (script_dir, *script_dir.parents):
+        config_path = path / "etc" / "devices.conf"
+        if config_path.is_file():
+            return config_path
+    return None
+
+@functools.lru_cache(maxsize=1)
 def load_devices_config():
     """Load the devices configuration from the devices.conf file."""
-    script_dir = get_script_dir()
-    repo_root = os.path.dirname(os.path.dirname(script_dir))
-    config_path = os.path.join(repo_root, "CorneZMK", "etc", "devices.conf")
-    
-    # If the path doesn't exist, try a relative path from the current directory
-    if not os.path.exists(config_path):
-        config_path = os.path.join(repo_root, "etc", "devices.conf")
-    
-    # If still not found, try an absolute path
-    if not os.path.exists(config_path):
-        config_path = "/home/jjb/src/zmk/CorneZMK/etc/devices.conf"
-    
-    if not os.path.exists(config_path):
-        print(f"Error: Could not find devices.conf at {config_path}", file=sys.stderr)
+    config_path = _find_devices_conf()
+    if config_path is None:
+        print(f"Error: Could not find etc/devices.conf above {get_script_dir()}", file=sys.stderr)
         sys.exit(1)
     
+    # yaml.safe_load skips the leading comments itself
     with open(config_path, 'r') as f:
-        # Skip comments at the beginning of the file
-        content = ""
-        for line in f:
-            if not line.strip().startswith('#') or content:
-                content += line
-        
         try:
-            config = yaml.safe_load(content)
+            config = yaml.safe_load(f)
             return config.get('devices', {})
         except yaml.YAMLError as e:
             print(f"Error parsing devices.conf: {e}", file=sys.stderr)
             sys.exit(1)
 
-def find_matching_devices(devices_config, debug=False, list_all=False):
-    """Find bootloader devices that match the configurations in devices.conf."""
+def _is_candidate(dev_name):
+    """Return True if /sys/block/<dev_name> looks like a removable drive with media."""
+    # UF2 bootloaders show up as removable mass storage; this skips internal disks
+    # and empty card-reader slots with two sysfs reads before any udev lookup
+    try:
+        with open(f"/sys/block/{dev_name}/removable") as f:
+            if f.read().strip() != "1":
+                return False
+        with open(f"/sys/block/{dev_name}/size") as f:
+            return f.read().strip() != "0"
+    except OSError:
+        return False
+
+def _parse_udev(data):
+    """Parse udev properties (KEY=value lines, or E: records) from bytes into a dict in one pass."""
+    return {m.group(1).decode(): m.group(2).decode(errors='replace').strip('"')
+            for m in _UDEV_PROPERTY.finditer(data)}
+
+def _read_udev_db(dev_name):
+    """Return the udev properties of block device /dev/<dev_name> as a dict, or None."""
+    # udev keeps its database on tmpfs under /run/udev/data, keyed by the device's
+    # major:minor; reading it directly avoids a udevadm process per device
+    try:
+        with open(f"/sys/block/{dev_name}/dev") as f:
+            major_minor = f.read().strip()
+        with open(f"/run/udev/data/b{major_minor}", 'rb') as f:
+            return _parse_udev(f.read())
+    except OSError:
+        pass
+    
+    # Fall back to udevadm where the database isn't readable
+    try:
+        udev_info = subprocess.check_output(
+            ['udevadm', 'info', '--query=property', '--name', f"/dev/{dev_name}"],
+            stderr=subprocess.DEVNULL
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return _parse_udev(udev_info)
+
+def _read_sysfs_attr(dev_path, name):
+    """Return the stripped contents of a sysfs attribute file, or None if unreadable."""
+    try:
+        with open(dev_path / name) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _usb_ids():
+    """Return the set of (vendor_id, product_id) pairs of connected USB devices."""
+    # Same data lsusb prints, read straight from sysfs; interface nodes
+    # (e.g. 1-1:1.0) have no idVendor and are skipped
+    usb_ids = set()
+    for dev_path in Path('/sys/bus/usb/devices').glob('*'):
+        vendor_id = _read_sysfs_attr(dev_path, "idVendor")
+        product_id = _read_sysfs_attr(dev_path, "idProduct")
+        if vendor_id and product_id:
+            usb_ids.add((vendor_id.lower(), product_id.lower()))
+    return usb_ids
+
+def print_usb_devices():
+    """Print connected USB devices in an lsusb-like format from sysfs."""
+    for dev_path in sorted(Path('/sys/bus/usb/devices').glob('*')):
+        vendor_id = _read_sysfs_attr(dev_path, "idVendor")
+        if not vendor_id:
+            continue
+        product_id = _read_sysfs_attr(dev_path, "idProduct")
+        manufacturer = _read_sysfs_attr(dev_path, "manufacturer") or ""
+        product = _read_sysfs_attr(dev_path, "product") or ""
+        print(f"{dev_path.name}: ID {vendor_id}:{product_id} {manufacturer} {product}".rstrip())
+
+def print_block_devices():
+    """Print the /dev/sd* nodes in an ls -l like format."""
+    entries = sorted((e for e in os.scandir('/dev') if e.name.startswith('sd')), key=lambda e: e.name)
+    if not entries:
+        print("No /dev/sd* devices found")
+    for entry in entries:
+        st = entry.stat()
+        mtime = time.strftime("%b %d %H:%M", time.localtime(st.st_mtime))
+        print(f"{stat.filemode(st.st_mode)} {os.major(st.st_rdev)}, {os.minor(st.st_rdev)} {mtime} {entry.path}")
+
+def find_matching_devices(devices_config, debug=False, list_all=False, first_match=False):
+    """Find bootloader devices that match the configurations in devices.conf.
+
+    Returns (nickname, device_path, vendor_id, product_id) tuples, plus the
+    list of all bootloader devices when list_all is set. With first_match the
+    scan stops at the first matching device and returns at most one.
+    """
     matching_devices = []
     all_devices = []
     
+    # One lookup per USB/block device instead of a scan over every config entry
+    nickname_by_id = {
+        (info.get('vendor_id', '').lower(), info.get('product_id', '').lower()): nickname
+        for nickname, info in devices_config.items()
+    }
+    
     if debug:
         print("\nScanning for bootloader devices...")
         # Show all block devices for debugging
         print("Available block devices:")
-        try:
-            result = subprocess.check_output(['ls', '-la', '/dev/sd*'], universal_newlines=True, stderr=subprocess.PIPE)
-            print(result)
-        except subprocess.CalledProcessError as e:
-            print(f"No /dev/sd* devices found: {e.stderr if hasattr(e, 'stderr') else ''}")
+        print_block_devices()
+    
+    # Collect the removable storage devices and read their udev properties once;
+    # both passes below work from these
+    candidates = []
+    for entry in os.scandir('/sys/block'):
+        device_name = entry.name
+        device_path = f"/dev/{device_name}"
+        
+        if not device_name.startswith("sd"):
+            if debug:
+                print(f"Skipping non-sd device: {device_path}")
+            continue
+            
+        if not _is_candidate(device_name):
+            if debug:
+                print(f"Skipping non-removable or empty device: {device_path}")
+            continue
+        
+        candidates.append(device_name)
+    
+    # --list-all wants every device, so it never stops early
+    stop_early = first_match and not list_all
+    if stop_early:
+        # Probe one device at a time so the block pass can stop at the first hit;
+        # it finds the same devices as the USB pass, so that one is skipped
+        probed = ((name, _read_udev_db(name)) for name in candidates)
+        usb_ids = ()
+    else:
+        # Look the candidates up in the udev database concurrently; a few workers is
+        # plenty for a handful of keyboards without hammering hosts with many disks
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            probed = list(zip(candidates, executor.map(_read_udev_db, candidates)))
+        usb_ids = _usb_ids()
     
     # First try direct USB device detection
-    try:
+    if debug and usb_ids:
+        print("\nChecking USB devices directly...")
+    
+    # Parse the USB device list to find matching devices
+    for vendor_id, product_id in usb_ids:
         if debug:
-            print("\nChecking USB devices directly...")
+            print(f"Found USB device: vendor_id={vendor_id}, product_id={product_id}")
         
-        # Get list of USB devices using lsusb
-        lsusb_output = subprocess.check_output(['lsusb'], universal_newlines=True)
+        # Check if this device matches any in our config
+        nickname = nickname_by_id.get((vendor_id, product_id))
+        if not nickname:
+            continue
+        
+        # For matching USB devices, try to find corresponding block device
+        if debug:
+            print(f"USB device matches config: {nickname} ({vendor_id}:{product_id})")
+            print(f"Searching for corresponding block device...")
         
-        # Parse lsusb output to find matching devices
-        for line in lsusb_output.splitlines():
-            match = re.search(r'ID (\w+):(\w+)', line)
-            if match:
-                vendor_id = match.group(1).lower()
-                product_id = match.group(2).lower()
+        # Try to find a block device with matching vendor/product ID
+        for device_name, udev_props in probed:
+            if udev_props is None:
+                continue
+            sd_device = f"/dev/{device_name}"
+            
+            # Check if this block device has matching vendor/product ID
+            if (vendor_id in (udev_props.get("ID_VENDOR_ID"), udev_props.get("ID_USB_VENDOR_ID")) and
+                    product_id in (udev_props.get("ID_MODEL_ID"), udev_props.get("ID_USB_MODEL_ID"))):
                 
+                matching_devices.append((nickname, sd_device, vendor_id, product_id))
                 if debug:
-                    print(f"Found USB device: vendor_id={vendor_id}, product_id={product_id}")
-                
-                # Check if this device matches any in our config
-                for nickname, device_info in devices_config.items():
-                    if (device_info.get('vendor_id', '').lower() == vendor_id and 
-                        device_info.get('product_id', '').lower() == product_id):
-                        
-                        # For matching USB devices, try to find corresponding block device
-                        if debug:
-                            print(f"USB device matches config: {nickname} ({vendor_id}:{product_id})")
-                            print(f"Searching for corresponding block device...")
-                        
-                        # Try to find a block device with matching vendor/product ID
-                        for sd_path in Path('/sys/block').glob('sd*'):
-                            sd_device = f"/dev/{sd_path.name}"
-                            try:
-                                udev_info = subprocess.check_output(
-                                    ['udevadm', 'info', '--query=all', '--name', sd_device],
-                                    stderr=subprocess.DEVNULL,
-                                    universal_newlines=True
-                                )
-                                
-                                # Check if this block device has matching vendor/product ID
-                                if (f"ID_VENDOR_ID={vendor_id}" in udev_info or 
-                                    f"ID_USB_VENDOR_ID={vendor_id}" in udev_info) and \
-                                   (f"ID_MODEL_ID={product_id}" in udev_info or 
-                                    f"ID_USB_MODEL_ID={product_id}" in udev_info):
-                                    
-                                    matching_devices.append((nickname, sd_device))
-                                    if debug:
-                                        print(f"Found matching block device: {nickname} -> {sd_device}")
-                            except subprocess.CalledProcessError:
-                                continue
-    except subprocess.CalledProcessError:
-        if debug:
-            print("Failed to run lsusb command")
+                    print(f"Found matching block device: {nickname} -> {sd_device}")
     
     # Also check all block devices directly - focusing on removable storage devices
-    for dev_path in Path('/sys/block').glob('*'):
-        device_name = dev_path.name
+    for device_name, udev_props in probed:
         device_path = f"/dev/{device_name}"
-        
-        # Skip devices that don't exist or aren't block devices
-        if not os.path.exists(device_path):
-            if debug:
-                print(f"Device path does not exist: {device_path}")
-            continue
-            
-        if not device_path.startswith("/dev/sd"):
-            if debug:
-                print(f"Skipping non-sd device: {device_path}")
-            continue
-            
-        # Get device information using udevadm
-        try:
-            udev_info = subprocess.check_output(
-                ['udevadm', 'info', '--query=all', '--name', device_path],
-                stderr=subprocess.DEVNULL,
-                universal_newlines=True
-            )
-        except subprocess.CalledProcessError:
+        if udev_props is None:
             continue
             
         if debug:
             print(f"Checking block device: {device_path}")
         
-        # Extract vendor and product IDs from udevadm output
-        vendor_id = None
-        product_id = None
-        removable = False
-        
-        for line in udev_info.splitlines():
-            if "ID_VENDOR_ID" in line or "ID_USB_VENDOR_ID" in line:
-                match = re.search(r'=([\da-fA-F]+)', line)
-                if match:
-                    vendor_id = match.group(1).lower()
-            elif "ID_MODEL_ID" in line or "ID_USB_MODEL_ID" in line:
-                match = re.search(r'=([\da-fA-F]+)', line)
-                if match:
-                    product_id = match.group(1).lower()
-            elif "ATTR{removable}" in line:
-                match = re.search(r'="(\d+)"', line)
-                if match and match.group(1) == "1":
-                    removable = True
-        
-        # Only consider removable devices (typical for bootloader mode)
-        if not removable and not device_path.startswith("/dev/sd"):
-            if debug:
-                print(f"Skipping non-removable device: {device_path}")
-            continue
+        # Extract vendor and product IDs from the udev properties
+        vendor_id = (udev_props.get("ID_USB_VENDOR_ID") or udev_props.get("ID_VENDOR_ID") or "").lower() or None
+        product_id = (udev_props.get("ID_USB_MODEL_ID") or udev_props.get("ID_MODEL_ID") or "").lower() or None
         
         if vendor_id and product_id:
             # Get device description if available
-            description = "Unknown"
-            for line in udev_info.splitlines():
-                if "ID_MODEL=" in line:
-                    match = re.search(r'=(.*)', line)
-                    if match:
-                        description = match.group(1)
-                        break
+            description = udev_props.get("ID_MODEL", "Unknown")
                         
             if list_all:
                 all_devices.append((vendor_id, product_id, device_path, description))
                 
             # Check if this device matches any in our config
-            for nickname, device_info in devices_config.items():
-                if (device_info.get('vendor_id', '').lower() == vendor_id and 
-                    device_info.get('product_id', '').lower() == product_id):
-                    matching_devices.append((nickname, device_path))
-                    if debug:
-                        print(f"Found bootloader device: {nickname} -> {device_path} ({vendor_id}:{product_id})")
+            nickname = nickname_by_id.get((vendor_id, product_id))
+            if nickname:
+                matching_devices.append((nickname, device_path, vendor_id, product_id))
+                if debug:
+                    print(f"Found bootloader device: {nickname} -> {device_path} ({vendor_id}:{product_id})")
+                if stop_early:
+                    break
     
     # We're only looking for bootloader devices, which appear as block devices
     # So we don't need to check for USB devices that aren't mounted as block devices
     
+    # The USB and block device passes can both report the same device
+    matching_devices = list({match[1]: match for match in matching_devices}.values())
+    
     if list_all:
         return matching_devices, all_devices
     return matching_devices
 
 def check_bootloader_device(device_path, debug=False):
     """Check if a device is in bootloader mode by examining its properties."""
-    try:
-        # Get device information using udevadm
-        udev_info = subprocess.check_output(
-            ['udevadm', 'info', '--query=all', '--name', device_path],
-            stderr=subprocess.DEVNULL,
-            universal_newlines=True
-        )
-        
-        # Characteristics of bootloader devices:
-        # 1. Usually removable
-        # 2. Often have specific vendor/product IDs
-        # 3. Usually appear as a mass storage device
-        removable = False
-        is_usb = False
-        vendor_id = None
-        product_id = None
-        
-        for line in udev_info.splitlines():
-            if "ATTR{removable}" in line and "=\"1\"" in line:
-                removable = True
-            elif "ID_BUS=\"usb\"" in line:
-                is_usb = True
-            elif "ID_VENDOR_ID" in line or "ID_USB_VENDOR_ID" in line:
-                match = re.search(r'=\"([\da-fA-F]+)\"', line)
-                if match:
-                    vendor_id = match.group(1).lower()
-            elif "ID_MODEL_ID" in line or "ID_USB_MODEL_ID" in line:
-                match = re.search(r'=\"([\da-fA-F]+)\"', line)
-                if match:
-                    product_id = match.group(1).lower()
-        
-        # A device is likely in bootloader mode if it's removable, USB, and has vendor/product IDs
-        is_bootloader = removable and is_usb and vendor_id and product_id
-        
-        if debug and is_bootloader:
-            print(f"Device {device_path} appears to be in bootloader mode:")
-            print(f"  Vendor ID: {vendor_id}, Product ID: {product_id}")
-            print(f"  Removable: {removable}, USB: {is_usb}")
-        
-        if is_bootloader:
-            return True, vendor_id, product_id
-        return False, None, None
-        
-    except subprocess.CalledProcessError:
+    dev_name = os.path.basename(device_path)
+    udev_props = _read_udev_db(dev_name)
+    if udev_props is None:
         return False, None, None
+    
+    # Characteristics of bootloader devices:
+    # 1. Usually removable
+    # 2. Often have specific vendor/product IDs
+    # 3. Usually appear as a mass storage device
+    removable = _is_candidate(dev_name)
+    is_usb = udev_props.get("ID_BUS") == "usb"
+    vendor_id = (udev_props.get("ID_USB_VENDOR_ID") or udev_props.get("ID_VENDOR_ID") or "").lower() or None
+    product_id = (udev_props.get("ID_USB_MODEL_ID") or udev_props.get("ID_MODEL_ID") or "").lower() or None
+    
+    # A device is likely in bootloader mode if it's removable, USB, and has vendor/product IDs
+    is_bootloader = removable and is_usb and vendor_id and product_id
+    
+    if debug and is_bootloader:
+        print(f"Device {device_path} appears to be in bootloader mode:")
+        print(f"  Vendor ID: {vendor_id}, Product ID: {product_id}")
+        print(f"  Removable: {removable}, USB: {is_usb}")
+    
+    if is_bootloader:
+        return True, vendor_id, product_id
+    return False, None, None
 
 def main():
     # Parse command line arguments
@@ -262,86 +303,19 @@ def main():
     
     # Show raw USB device information if requested
     if args.raw_usb or args.debug:
-        try:
-            print("\nRaw USB device information:")
-            lsusb_output = subprocess.check_output(['lsusb'], universal_newlines=True)
-            print(lsusb_output)
-        except subprocess.CalledProcessError:
-            print("Failed to run lsusb command")
-    
-    # Direct check of block devices
-    if args.debug:
-        print("\nDirect check of block devices:")
-        try:
-            result = subprocess.check_output(['ls', '-la', '/dev/sd*'], universal_newlines=True)
-            print(result)
-        except subprocess.CalledProcessError as e:
-            print(f"No /dev/sd* devices found")
+        print("\nRaw USB device information:")
+        print_usb_devices()
     
     # Scan for bootloader devices
-    matching_devices = []
-    all_devices = []
-    
-    # Check all potential block devices that might be in bootloader mode
-    for dev_path in Path('/sys/block').glob('sd*'):
-        device_path = f"/dev/{dev_path.name}"
-        
-        if args.debug:
-            print(f"Checking potential bootloader device: {device_path}")
-        
-        # Get device information using udevadm
-        try:
-            udev_info = subprocess.check_output(
-                ['udevadm', 'info', '--query=all', '--name', device_path],
-                stderr=subprocess.DEVNULL,
-                universal_newlines=True
-            )
-            
-            # Extract vendor and product IDs and serial number
-            vendor_id = None
-            product_id = None
-            serial = None
-            description = "Unknown"
-            
-            for line in udev_info.splitlines():
-                if "ID_VENDOR_ID=" in line:
-                    vendor_id = line.split('=')[1].strip('"').lower()
-                elif "ID_USB_VENDOR_ID=" in line:
-                    vendor_id = line.split('=')[1].strip('"').lower()
-                elif "ID_MODEL_ID=" in line:
-                    product_id = line.split('=')[1].strip('"').lower()
-                elif "ID_USB_MODEL_ID=" in line:
-                    product_id = line.split('=')[1].strip('"').lower()
-                elif "ID_MODEL=" in line:
-                    description = line.split('=')[1].strip('"')
-            
-            if args.debug and vendor_id and product_id:
-                print(f"  Found device with vendor_id={vendor_id}, product_id={product_id}")
-            
-            # Check if this device matches any in our config
-            if vendor_id and product_id:
-                for nickname, device_info in devices_config.items():
-                    config_vendor_id = device_info.get('vendor_id', '').lower()
-                    config_product_id = device_info.get('product_id', '').lower()
-                    
-                    if args.debug:
-                        print(f"  Comparing with {nickname}: {config_vendor_id}:{config_product_id}")
-                    
-                    if config_vendor_id == vendor_id and config_product_id == product_id:
-                        matching_devices.append((nickname, device_path))
-                        if args.debug:
-                            print(f"  MATCH FOUND: {nickname} -> {device_path}")
-                
-                # Add to all devices list if requested
-                if args.list_all:
-                    all_devices.append((vendor_id, product_id, device_path, description))
-        except subprocess.CalledProcessError:
-            if args.debug:
-                print(f"  Failed to get udev info for {device_path}")
+    if args.list_all:
+        matching_devices, all_devices = find_matching_devices(devices_config, debug=args.debug, list_all=True)
+    else:
+        matching_devices = find_matching_devices(devices_config, debug=args.debug)
+        all_devices = []
     
     # Display results
     if matching_devices:
-        for nickname, device_path in matching_devices:
+        for nickname, device_path, _, _ in matching_devices:
             if args.debug:
                 print(f"{nickname}: {device_path}")
             else:
@@ -358,7 +332,7 @@ def main():
     if args.debug and not matching_devices:
         print("\nNo matches found. Check if the device is in bootloader mode and properly connected.")
         print("Also verify that the vendor_id and product_id in devices.conf match your device.")
-        print("You can use 'lsusb' to see connected USB devices and their IDs.")
+        print("You can use --raw-usb to see connected USB devices and their IDs.")
 
 if __name__ == "__main__":
     main()
@@ -4,8 +4,8 @@
 ZMK Firmware Flashing Script for Corne Keyboard (Python Version)
 
 This script flashes ZMK firmware to a Corne keyboard using the device
-information from devices.conf. It uses find_devices.py to locate the
-appropriate device.
+information from devices.conf. It uses find_matching_devices() from
+find_devices.py to locate the appropriate device.
 
 Usage: ./flash_firmware.py [options]
 Options:
@@ -24,43 +24,25 @@ import time
 import shutil
 from pathlib import Path
 
+from find_devices import find_matching_devices
+
 # Default values
 DEFAULT_SIDE = "left"
 DEFAULT_VARIANT = "default"
 DEFAULT_DEVICE = "corne_ergokeeb"
 DEFAULT_MOUNT_POINT = os.path.expanduser("~/mnt/corne")
 DEFAULT_DESTINATION_FIRMWARE_NAME = "CURRENT.UF2"
-DEFAULT_READY_TIME = 20  # seconds to wait for flashing to complete
+DEFAULT_READY_TIME = 20  # max seconds to wait for the device to reset after flashing
 
 
 def find_root_dir(start_dir):
     """Find CorneZMK root directory"""
+    # The root is the nearest directory at or above start_dir holding the devices config,
+    # wherever the checkout lives and whatever it is called
     current_dir = Path(start_dir).resolve()
-    
-    # Check if current directory is CorneZMK
-    if current_dir.name == "CorneZMK":
-        return current_dir
-    
-    # Check if current directory contains CorneZMK
-    if (current_dir / "CorneZMK").exists():
-        return current_dir / "CorneZMK"
-    
-    # Check if scripts directory is in current path
-    if current_dir.name == "scripts" and current_dir.parent.exists():
-        parent_dir = current_dir.parent
-        if parent_dir.name == "CorneZMK":
-            return parent_dir
-    
-    # Check if we're in zmk/CorneZMK
-    if "/zmk/CorneZMK" in str(current_dir):
-        parts = str(current_dir).split("/zmk/CorneZMK")
-        return Path(f"{parts[0]}/zmk/CorneZMK")
-    
-    # Check if we're in src/zmk/CorneZMK
-    if "/src/zmk/CorneZMK" in str(current_dir):
-        parts = str(current_dir).split("/src/zmk/CorneZMK")
-        return Path(f"{parts[0]}/src/zmk/CorneZMK")
-    
+    for candidate in [current_dir, *current_dir.parents]:
+        if (candidate / "etc" / "devices.conf").is_file():
+            return candidate
     return None
 
 
@@ -74,108 +56,50 @@ def load_devices_config(config_path):
         sys.exit(1)
 
 
-def find_device(script_dir, debug=False):
-    """Find the appropriate device using find_devices.py"""
-    find_devices_script = os.path.join(script_dir, "find_devices.py")
+def find_device(devices_config, debug=False):
+    """Find the appropriate bootloader device using find_devices.find_matching_devices
+
+    Returns (device_path, vendor_id, product_id) for the first device found.
+    """
+    # Scan in-process with the already-loaded devices.conf instead of spawning
+    # find_devices.py, which would re-import yaml and re-read the config
+    devices = find_matching_devices(devices_config, debug=debug, first_match=True)
     
-    # Check if the script exists
-    if not os.path.isfile(find_devices_script):
-        print(f"Error: find_devices.py not found at {find_devices_script}")
+    if not devices:
+        print("No bootloader device found")
         sys.exit(1)
     
-    try:
-        # Run find_devices.py to locate the device
-        cmd = [sys.executable, find_devices_script]  # Use sys.executable to ensure correct Python interpreter
-        if debug:
-            cmd.append("--debug")
-            
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        # The script outputs the device path to stdout
-        output = result.stdout.strip()
-        
-        # Parse the output to get the device path
-        # find_devices.py outputs the device path on its own line
-        device_paths = [line for line in output.split('\n') if line.startswith('/dev/')]
-        
-        if not device_paths:
-            print("No bootloader device found")
-            if debug:
-                print(f"find_devices.py output: {output}")
-            sys.exit(1)
-        
-        # Use the first device found
-        device_path = device_paths[0]
-        print(f"Found bootloader device: {device_path}")
-        return device_path
-    except subprocess.CalledProcessError as e:
-        print(f"Error running find_devices.py: {e}")
-        if e.stdout:
-            print(f"Output: {e.stdout}")
-        if e.stderr:
-            print(f"Error: {e.stderr}")
-        sys.exit(1)
+    # Use the first device found
+    _, device_path, vendor_id, product_id = devices[0]
+    print(f"Found bootloader device: {device_path}")
+    return device_path, vendor_id, product_id
 
 
-def verify_device(device_path, device_config, debug=False):
+def verify_device(device_path, vendor_id, product_id, device_config, debug=False):
     """Verify that the found device matches the expected device configuration"""
+    # The IDs come from the scan that found the device; just make sure it's still there
     if not os.path.exists(device_path):
         print(f"Error: Device path {device_path} does not exist")
         sys.exit(1)
     
-    try:
-        # Use udevadm to get device information
-        udev_info = subprocess.run(
-            ['udevadm', 'info', '--query=all', '--name', device_path],
-            capture_output=True,
-            text=True,
-            check=True
-        )
-        
-        # Extract vendor and product IDs
-        vendor_id = None
-        product_id = None
-        
-        for line in udev_info.stdout.splitlines():
-            if "ID_VENDOR_ID=" in line:
-                vendor_id = line.split('=')[1].strip('"').lower()
-            elif "ID_USB_VENDOR_ID=" in line:
-                vendor_id = line.split('=')[1].strip('"').lower()
-            elif "ID_MODEL_ID=" in line:
-                product_id = line.split('=')[1].strip('"').lower()
-            elif "ID_USB_MODEL_ID=" in line:
-                product_id = line.split('=')[1].strip('"').lower()
-        
-        if debug:
-            print(f"Found device: vendor_id={vendor_id}, product_id={product_id}")
-            print(f"Expected: vendor_id={device_config.get('vendor_id', '').lower()}, "
-                  f"product_id={device_config.get('product_id', '').lower()}")
-        
-        # Verify that the device matches the expected configuration
-        if (vendor_id != device_config.get('vendor_id', '').lower() or
-                product_id != device_config.get('product_id', '').lower()):
-            print(f"Warning: Device at {device_path} does not match expected configuration")
-            print(f"Found: vendor_id={vendor_id}, product_id={product_id}")
-            print(f"Expected: vendor_id={device_config.get('vendor_id', '')}, "
-                  f"product_id={device_config.get('product_id', '')}")
-            
-            response = input("Continue anyway? (y/n): ")
-            if response.lower() != 'y':
-                sys.exit(1)
+    if debug:
+        print(f"Found device: vendor_id={vendor_id}, product_id={product_id}")
+        print(f"Expected: vendor_id={device_config.get('vendor_id', '').lower()}, "
+              f"product_id={device_config.get('product_id', '').lower()}")
+    
+    # Verify that the device matches the expected configuration
+    if (vendor_id != device_config.get('vendor_id', '').lower() or
+            product_id != device_config.get('product_id', '').lower()):
+        print(f"Warning: Device at {device_path} does not match expected configuration")
+        print(f"Found: vendor_id={vendor_id}, product_id={product_id}")
+        print(f"Expected: vendor_id={device_config.get('vendor_id', '')}, "
+              f"product_id={device_config.get('product_id', '')}")
         
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"Error verifying device: {e}")
-        if e.stdout:
-            print(f"Output: {e.stdout}")
-        if e.stderr:
-            print(f"Error: {e.stderr}")
-        sys.exit(1)
+        response = input("Continue anyway? (y/n): ")
+        if response.lower() != 'y':
+            sys.exit(1)
+    
+    return True
 
 
 def flash_firmware(device_path, firmware_path, mount_point, destination_name, ready_time):
@@ -194,15 +118,32 @@ def flash_firmware(device_path, firmware_path, mount_point, destination_name, re
     try:
         # Mount the device
         print(f"Mounting {device_path} to {mount_point}")
-        subprocess.run(['sudo', 'mount', device_path, mount_point], check=True)
+        # UF2 drives are FAT, so uid/gid make the mount writable by us without sudo cp
+        subprocess.run(['sudo', 'mount', '-o', f'uid={os.getuid()},gid={os.getgid()}',
+                        device_path, mount_point], check=True)
         
-        # Copy the firmware
-        print(f"Copying firmware from {firmware_path} to {os.path.join(mount_point, destination_name)}")
-        subprocess.run(['sudo', 'cp', firmware_path, os.path.join(mount_point, destination_name)], check=True)
+        # Copy the firmware and fsync it, so the bytes have reached the device
+        # before we start waiting for the bootloader to reset
+        destination_path = os.path.join(mount_point, destination_name)
+        print(f"Copying firmware from {firmware_path} to {destination_path}")
+        try:
+            with open(firmware_path, 'rb') as src, open(destination_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 64 * 1024)
+                dst.flush()
+                os.fsync(dst.fileno())
+        except OSError:
+            # The bootloader resets as soon as it has every image block, which can be
+            # before the FAT/directory metadata is written; that EIO means it worked
+            if os.path.exists(device_path):
+                raise
+            print("Device reset while the copy was being flushed; the firmware was taken")
         
-        # Wait for flashing to complete
-        print(f"Flashing firmware... please wait {ready_time} seconds")
-        time.sleep(ready_time)
+        # Wait for flashing to complete; the UF2 bootloader resets once it has
+        # taken the image, so the device node going away means we're done
+        print(f"Flashing firmware... waiting up to {ready_time} seconds for the device to reset")
+        deadline = time.monotonic() + ready_time
+        while os.path.exists(device_path) and time.monotonic() < deadline:
+            time.sleep(0.1)
         
         # Unmount the device
         print("Unmounting device")
@@ -210,7 +151,7 @@ def flash_firmware(device_path, firmware_path, mount_point, destination_name, re
         
         print("Flashing complete!")
         return True
-    except subprocess.CalledProcessError as e:
+    except (subprocess.CalledProcessError, OSError) as e:
         print(f"Error flashing firmware: {e}")
         # Try to unmount the device if it was mounted
         try:
@@ -234,7 +175,7 @@ def main():
     parser.add_argument("--mount-point", dest="mount_point", default=DEFAULT_MOUNT_POINT,
                         help=f"Mount point for the device (default: {DEFAULT_MOUNT_POINT})")
     parser.add_argument("--ready-time", dest="ready_time", type=int, default=DEFAULT_READY_TIME,
-                        help=f"Time to wait for flashing to complete in seconds (default: {DEFAULT_READY_TIME})")
+                        help=f"Maximum time to wait for flashing to complete in seconds (default: {DEFAULT_READY_TIME})")
     
     args = parser.parse_args()
     
@@ -263,17 +204,16 @@ def main():
     devices_conf_path = os.path.join(root_dir, "etc", "devices.conf")
     devices_config = load_devices_config(devices_conf_path)
     
-    # Get device information
-    if args.device_name not in devices_config.get('devices', {}):
+    # Get device configuration
+    by_nickname = devices_config.get('devices', {})
+    device_config = by_nickname.get(args.device_name)
+    if device_config is None:
         print(f"Error: Device '{args.device_name}' not found in devices.conf")
         print("Available devices:")
-        for device_name in devices_config.get('devices', {}).keys():
+        for device_name in by_nickname:
             print(f"  - {device_name}")
         sys.exit(1)
     
-    # Get device configuration
-    device_config = devices_config['devices'][args.device_name]
-    
     # Get keyboard name from device config
     keyboard_name = device_config.get('keyboard_name')
     if not keyboard_name:
@@ -311,10 +251,10 @@ def main():
     print(f"Flashing {args.side} side with {args.variant} firmware: {firmware_path}")
     
     # Find the bootloader device
-    device_path = find_device(script_dir, args.debug)
+    device_path, vendor_id, product_id = find_device(by_nickname, args.debug)
     
     # Verify the device
-    verify_device(device_path, device_config, args.debug)
+    verify_device(device_path, vendor_id, product_id, device_config, args.debug)
     
     # Flash the firmware
     flash_firmware(
@@ -0,0 +1,33 @@
+"""File copy and hashing helpers shared by the build scripts"""
+import hashlib
+import shutil
+import sys
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows
+
+# ioctl request number for cloning a file's extents (Linux, see ioctl_ficlone(2))
+FICLONE = 0x40049409
+
+def reflink_or_copy(src, dst):
+    """Copy src to dst as a copy-on-write clone where the filesystem supports it.
+    
+    Hard links are deliberately not used: the build rewrites its outputs in place,
+    which would silently change an already-copied file.
+    """
+    if fcntl is not None and sys.platform.startswith("linux"):
+        try:
+            with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+                fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+            shutil.copystat(src, dst)
+            return
+        except OSError:
+            pass  # Not supported here (e.g. ext4 or a different filesystem); copy normally
+    # copyfile uses the kernel's in-kernel copy fast path on Linux
+    shutil.copy2(src, dst)
+
+def file_sha256(path):
+    """Return the hex sha256 digest of a file"""
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
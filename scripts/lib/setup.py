@@ -2,28 +2,38 @@
 import subprocess
 import sys
 import os
+import hashlib
+import functools
 from pathlib import Path
-import venv
 
 LIB_DIR = Path(__file__).resolve().parent
 PROJECT_DIR = LIB_DIR.parent.parent
 PROJECT_NAME = "jjb-zmk"
 VAR_DIR = Path.home() / ".local" / "var" / PROJECT_NAME
 VENV_DIR = VAR_DIR / "venv"
-VENV_DIR.mkdir(parents=True, exist_ok=True)
+_VENV_PREFIX = os.path.realpath(VENV_DIR)
+MIN_PIP_VERSION = (24, 0)  # older venv pips get upgraded before installing modules
 
+def pip_version(python_executable):
+    """Return the (major, minor) version of pip in the given interpreter, or (0, 0) if unknown"""
+    # "pip 24.0 from /path/to/site-packages/pip (python 3.12)"
+    result = subprocess.run([str(python_executable), "-m", "pip", "--version"], capture_output=True, text=True)
+    try:
+        return tuple(int(part) for part in result.stdout.split()[1].split(".")[:2])
+    except (IndexError, ValueError):
+        return (0, 0)
+
+@functools.lru_cache(maxsize=None)
 def is_in_venv():
     """Check if the current Python interpreter is running inside the project's venv"""
-    return (
-        hasattr(sys, 'real_prefix') or 
-        (hasattr(sys, 'base_prefix') and sys.base_prefix != sys.prefix) and
-        Path(sys.prefix).resolve() == VENV_DIR.resolve()
-    )
+    # Being in *some* venv isn't enough, it has to be this project's
+    return os.path.realpath(sys.prefix) == _VENV_PREFIX
 
 def initialize_venv(pip_modules=None):
     """
     Ensure a virtual environment exists in var/venv in the project directory.
-    Create it if absent, then upgrade pip and install/update the given pip_modules.
+    Create it if absent, then upgrade pip and install/update the given pip_modules,
+    unless that list was already installed (set JJB_ZMK_REFRESH_DEPS to force it).
     If not already running in the venv, re-execute the current script under the venv.
 
     Args:
@@ -41,22 +51,54 @@ def initialize_venv(pip_modules=None):
     else:
         python_executable = VENV_DIR / "bin" / "python"
 
-    if not python_executable.exists():
+    # venv.create makes the venv directory itself; VAR_DIR also holds the deps stamp
+    VAR_DIR.mkdir(parents=True, exist_ok=True)
+    # One access() call checks the interpreter both exists and is runnable
+    created = not os.access(python_executable, os.X_OK)
+    if created:
+        # Only the cold path pays for importing venv (and the sysconfig/shutil it pulls in)
+        import venv
         print(f"Creating virtual environment in {VENV_DIR}")
         venv.create(VENV_DIR, with_pip=True)
+        if not os.access(python_executable, os.X_OK):
+            print(f"Error: venv python executable not found at {python_executable}")
+            sys.exit(1)
     else:
         print(f"Virtual environment already exists in {VENV_DIR}")
 
-    if not python_executable.exists():
-        print(f"Error: venv python executable not found at {python_executable}")
-        sys.exit(1)
+    # Skip pip entirely when this module list was already installed into this venv
+    # since setup.py last changed; each caller's list gets its own stamp
+    fingerprint = hashlib.sha256(repr(sorted(pip_modules)).encode()).hexdigest()
+    stamp_file = VAR_DIR / f".deps-{fingerprint[:16]}.stamp"
+    stamp = f"{fingerprint} {sys.version}\n"
+    try:
+        up_to_date = (
+            not created and
+            not os.environ.get("JJB_ZMK_REFRESH_DEPS") and
+            stamp_file.stat().st_mtime > Path(__file__).stat().st_mtime and
+            stamp_file.read_text() == stamp
+        )
+    except OSError:
+        up_to_date = False
 
-    print("Upgrading pip...")
-    subprocess.run([str(python_executable), "-m", "pip", "install", "--upgrade", "pip"], check=True)
+    if up_to_date:
+        print("Python dependencies are up to date")
+    else:
+        # The pip that ensurepip bundles is usually recent enough; only upgrade older ones
+        packages = list(pip_modules)
+        if pip_version(python_executable) < MIN_PIP_VERSION:
+            packages.insert(0, "pip")
 
-    for module in pip_modules:
-        print(f"Installing/updating {module}...")
-        subprocess.run([str(python_executable), "-m", "pip", "install", "--upgrade", module], check=True)
+        if packages:
+            # One pip run resolves pip and every module together instead of paying
+            # an interpreter and pip startup per package
+            print(f"Installing/updating {', '.join(packages)}...")
+            pip_args = [str(python_executable), "-m", "pip", "--disable-pip-version-check", "install", "--upgrade"]
+            # CI machines are thrown away, so don't bother filling the pip cache there
+            if os.environ.get("CI"):
+                pip_args.append("--no-cache-dir")
+            subprocess.run([*pip_args, *packages], check=True)
+        stamp_file.write_text(stamp)
 
     if len(sys.argv) > 0:
         original_script = Path(sys.argv[0]).resolve()
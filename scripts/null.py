@@ -1,18 +1,10 @@
 #!/usr/bin/env python3
 import sys
 import os
-import subprocess
 import argparse
-from pathlib import Path
 
-# Add the lib directory to the Python path so we can import the setup module
-script_dir = Path(__file__).resolve().parent
-project_dir = script_dir.parent
-lib_dir = script_dir / "lib"
-sys.path.insert(0, str(lib_dir))
-
-# Import the setup module
-import setup
+# Python already puts this script's directory on sys.path, so lib imports as a package
+from lib import setup
 
 def start_interactive_repl():
     """
@@ -40,9 +32,9 @@ def main():
         start_interactive_repl()
         return  # This won't actually be reached due to os.execv
     
-    # Otherwise, list the libraries installed in the venv
-    result = subprocess.run([sys.executable, '-m', 'pip', 'list'], capture_output=True, text=True)
-    print(result.stdout)
+    # Otherwise, list the libraries installed in the venv; pip writes straight
+    # to our stdout instead of through a captured pipe
+    os.execv(sys.executable, [sys.executable, '-m', 'pip', 'list'])
 
 if __name__ == "__main__":
     main()